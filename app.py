@@ -1,16 +1,21 @@
 import os
-import random
-import string
 import base64
+import hashlib
+import hmac
+import json
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
 from io import BytesIO
 from datetime import datetime
+from zoneinfo import ZoneInfo
 import sqlite3
-import pytz
 import logging
 
-import qrcode
-import requests
+import aiosqlite
+import httpx
+import segno
+from aiosqlitepool import SQLiteConnectionPool
 from fastapi import FastAPI, Request, Form, Depends
 from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
@@ -20,7 +25,16 @@ from bakong_khqr import KHQR
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # ---------- App ----------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    poller = asyncio.create_task(payment_poller())
+    yield
+    poller.cancel()
+    await HTTP.aclose()
+    await pool.close()
+    QR_POOL.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 
 API_TOKEN = os.getenv("API_TOKEN", "your_api_token_here")
@@ -28,26 +42,99 @@ khqr = KHQR(API_TOKEN)
 BANK_ACCOUNT = os.getenv("BANK_ACCOUNT", "chhira_ly@aclb")
 PHONE_NUMBER = os.getenv("PHONE_NUMBER", "855882000544")
 TIMEZONE = os.getenv("TIMEZONE", "Asia/Phnom_Penh")
+TZ = ZoneInfo(TIMEZONE)
 DB = "bot_data.db"
+DEMO_USER_ID = 1
+DEMO_USERNAME = "demo_user"
+PAYMENT_CHECK_URL = "https://panha-dev.vercel.app/check_payment/{md5}"
+PAYMENT_TIMEOUT = 300  # 5 min
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_TOLERANCE = 300  # max age of a signed webhook request, in seconds
+# With the payment webhook configured, polling is only a safety net
+POLL_INTERVAL = 60 if WEBHOOK_SECRET else 8
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
 
 # Track active payments: user_id -> order_id
 users_in_payment = {}
 order_user_map = {}
 
+# Item prices per game, loaded by init_db(): game -> {item_id: {...}}
+_ITEM_CACHE = {}
+
+# Orders awaiting payment, checked in batches by payment_poller():
+# order_id -> (md5, user_id, created_ts)
+pending_orders = {}
+# Latest provider response per pending order, persisted only once it expires
+last_responses = {}
+
 # Store completed transactions (in-memory for now)
 REJECTS = {}
 
+# ---------- Database ----------
+# Route handlers share a pool of aiosqlite connections so queries never block
+# the event loop and each connection keeps its page cache warm between calls.
+# Connections run in autocommit mode; multi-statement writes open their own
+# transaction.
+def _conn_factory():
+    conn = sqlite3.connect(DB, timeout=30, check_same_thread=False, isolation_level=None)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+async def _aconn_factory():
+    conn = await aiosqlite.connect(DB, timeout=30, isolation_level=None)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+pool = SQLiteConnectionPool(_aconn_factory)
+
+# Query text is kept constant so each pooled connection's statement cache
+# reuses the prepared statement instead of re-parsing it on every call.
+SQL_GET_ITEM_PRICES = "SELECT game, item_id, normal_price, reseller_price FROM item_prices WHERE game IN ('MLBB', 'FF')"
+SQL_IS_RESELLER = "SELECT is_reseller FROM users WHERE user_id=?"
+SQL_ENSURE_USER = "INSERT OR IGNORE INTO users(user_id, username) VALUES(?, ?)"
+SQL_INSERT_ORDER = """
+    INSERT INTO orders (order_id, user_id, game, item_id, amount, server_id, zone_id, md5, status, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_MARK_PAID = "UPDATE orders SET status=?, paid_at=? WHERE order_id=?"
+SQL_MARK_EXPIRED = "UPDATE orders SET status=? WHERE order_id=?"
+SQL_FIND_SETTLEABLE_BY_MD5 = "SELECT order_id FROM orders WHERE md5=? AND status IN ('UNPAID', 'EXPIRED')"
+SQL_FILTER_UNPAID = "SELECT order_id FROM orders WHERE status='UNPAID' AND order_id IN (SELECT value FROM json_each(?))"
+SQL_INSERT_EVENT = "INSERT INTO order_events (order_id, ts, body) VALUES (?, ?, ?)"
+SQL_ORDER_STATUS = """
+    SELECT status,
+           COALESCE((SELECT body FROM order_events e WHERE e.order_id = o.order_id ORDER BY ts DESC LIMIT 1),
+                    payment_response),
+           paid_at
+    FROM orders o WHERE order_id=?
+"""
+
+# Shared client so payment checks reuse keep-alive TLS connections
+HTTP = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_keepalive_connections=32))
+
+# Bounded worker pool for CPU-bound QR generation off the event loop
+QR_POOL = ThreadPoolExecutor(max_workers=4)
+
 # ---------- Helpers ----------
 def now_iso():
-    tz = pytz.timezone(TIMEZONE)
-    return datetime.now(tz).isoformat()
+    return datetime.now(TZ).isoformat()
 
 def generate_short_transaction_id() -> str:
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    # 5 random bytes encode to exactly 8 base32 characters (A-Z, 2-7)
+    return base64.b32encode(os.urandom(5)).decode()
 
 def init_db():
-    with sqlite3.connect(DB) as conn:
+    with closing(_conn_factory()) as conn:
         c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
         c.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -80,6 +167,20 @@ def init_db():
                 paid_at TEXT
             )
         """)
+        # Provider payloads live here so orders rows stay narrow; orders.payment_response
+        # is only read as a fallback for rows written before this table existed
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS order_events (
+                order_id TEXT,
+                ts TEXT,
+                body BLOB
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_order_events_order_ts ON order_events(order_id, ts DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status) WHERE status='UNPAID'")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_md5 ON orders(md5)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_item_prices_game ON item_prices(game)")
         # Insert default items
         items = [
             ("86_DIAMOND", "MLBB", 0.03, 0.03),
@@ -99,23 +200,42 @@ def init_db():
             INSERT OR IGNORE INTO item_prices (item_id, game, normal_price, reseller_price)
             VALUES (?, ?, ?, ?)
         """, items)
+        # Demo user is auto-logged in by the routes, so create it up front
+        c.execute(SQL_ENSURE_USER, (DEMO_USER_ID, DEMO_USERNAME))
         conn.commit()
+        load_item_prices(conn)
     logging.info("Database initialized.")
 
+def load_item_prices(conn: sqlite3.Connection):
+    # Prices are static, so they are read once and served from memory.
+    # Call again after changing item_prices to refresh the cache.
+    _ITEM_CACHE.clear()
+    _ITEM_CACHE.update({"MLBB": {}, "FF": {}})
+    for game, item_id, normal, reseller in conn.execute(SQL_GET_ITEM_PRICES):
+        _ITEM_CACHE[game][item_id] = {"normal": normal, "reseller": reseller}
+
+def get_all_item_prices():
+    return _ITEM_CACHE
+
 def get_item_prices(game: str):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("SELECT item_id, normal_price, reseller_price FROM item_prices WHERE game=?", (game,))
-        rows = c.fetchall()
-    return {r[0]: {"normal": r[1], "reseller": r[2]} for r in rows}
+    return _ITEM_CACHE.get(game, {})
 
-def is_reseller(user_id: int):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("SELECT is_reseller FROM users WHERE user_id=?", (user_id,))
-        r = c.fetchone()
+async def is_reseller(user_id: int):
+    async with pool.connection() as conn:
+        c = await conn.execute(SQL_IS_RESELLER, (user_id,))
+        r = await c.fetchone()
     return r[0] == 1 if r else False
 
+def _render_qr(payload: str) -> str:
+    # Rendering is kept separate from payload creation: every payload carries a
+    # fresh bill number and timestamp, so neither it nor its image can be reused.
+    # A fixed mask and error level skip segno's mask-penalty and error-boost
+    # searches; the version is still fitted to the payload length
+    qr = segno.make(payload, error='m', mask=0, micro=False, boost_error=False)
+    buf = BytesIO()
+    qr.save(buf, kind='svg', xmldecl=False, scale=10)
+    return base64.b64encode(buf.getvalue()).decode()
+
 def generate_qr_code(amount: float):
     try:
         qr_payload = khqr.create_qr(
@@ -130,66 +250,85 @@ def generate_qr_code(amount: float):
             terminal_label='Cashier-01',
             static=False
         )
-        img = qrcode.make(qr_payload)
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
         md5_hash = khqr.generate_md5(qr_payload)
-        b64 = base64.b64encode(buf.getvalue()).decode()
-        return b64, md5_hash
+        return _render_qr(qr_payload), md5_hash
     except Exception as e:
         logging.error("QR generation failed: %s", e)
         return None, None
 
-async def check_payment_background(order_id: str, md5: str, user_id: int):
-    logging.info(f"Started async payment checker for order {order_id}")
-    start = datetime.now().timestamp()
-    while datetime.now().timestamp() - start < 300:  # 5 min
+async def fetch_payment(md5: str):
+    resp = await HTTP.get(PAYMENT_CHECK_URL.format(md5=md5))
+    return resp.json()
+
+def forget_order(order_id: str):
+    entry = pending_orders.pop(order_id, None)
+    last_responses.pop(order_id, None)
+    if entry:
+        users_in_payment.pop(entry[1], None)
+
+async def check_pending_payments():
+    now = datetime.now().timestamp()
+    due = [oid for oid, (_, _, created) in pending_orders.items() if now - created >= PAYMENT_TIMEOUT]
+    # Orders due to expire are checked one last time so a late payment is not lost
+    checks = [(oid, md5) for oid, (md5, _, _) in pending_orders.items()]
+    results = await asyncio.gather(*[fetch_payment(md5) for _, md5 in checks], return_exceptions=True)
+    paid = []
+    for (order_id, _), data in zip(checks, results):
+        if isinstance(data, BaseException):
+            logging.warning(f"Payment check failed for {order_id}: {data}")
+            continue
+        if not isinstance(data, dict):
+            logging.warning(f"Payment check failed for {order_id}: unexpected response {data!r}")
+            continue
+        if data.get("success") and data.get("status") == "PAID":
+            paid.append((order_id, json.dumps(data, separators=(",", ":"))))
+        else:
+            last_responses[order_id] = json.dumps(data, separators=(",", ":"))
+    paid_ids = {oid for oid, _ in paid}
+    expired = [(oid, last_responses.get(oid)) for oid in due if oid not in paid_ids]
+    # Only terminal transitions are written, all in a single transaction
+    if not (paid or expired):
+        return
+    ts = now_iso()
+    async with pool.connection() as conn:
+        await conn.execute("BEGIN IMMEDIATE")
         try:
-            url = f"https://panha-dev.vercel.app/check_payment/{md5}"
-            resp = requests.get(url, timeout=10)
-            data = resp.json()
-            # Update order response
-            with sqlite3.connect(DB) as conn:
-                c = conn.cursor()
-                c.execute("UPDATE orders SET payment_response=? WHERE order_id=?", (str(data), order_id))
-                conn.commit()
-            # If paid
-            if data.get("success") and data.get("status") == "PAID":
-                paid_at = now_iso()
-                with sqlite3.connect(DB) as conn:
-                    c = conn.cursor()
-                    c.execute("UPDATE orders SET status=?, paid_at=?, payment_response=? WHERE order_id=?",
-                              ("PAID", paid_at, str(data), order_id))
-                    conn.commit()
-                users_in_payment.pop(user_id, None)
-                logging.info(f"Order {order_id} marked as PAID")
-                return
-        except Exception as e:
-            logging.warning(f"Payment check failed for {order_id}: {e}")
-        await asyncio.sleep(8)
-    # Expired
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("UPDATE orders SET status=? WHERE order_id=?", ("EXPIRED", order_id))
-        conn.commit()
-    users_in_payment.pop(user_id, None)
-    logging.info(f"Order {order_id} expired.")
+            # Leave alone orders the webhook has settled in the meantime
+            c = await conn.execute(SQL_FILTER_UNPAID, (json.dumps([oid for oid, _ in paid + expired]),))
+            unpaid = {r[0] for r in await c.fetchall()}
+            await conn.executemany(SQL_MARK_PAID, [("PAID", ts, oid) for oid, _ in paid if oid in unpaid])
+            await conn.executemany(SQL_MARK_EXPIRED, [("EXPIRED", oid) for oid, _ in expired if oid in unpaid])
+            await conn.executemany(SQL_INSERT_EVENT, [(oid, ts, body) for oid, body in paid + expired if oid in unpaid and body is not None])
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    for order_id, _ in paid:
+        forget_order(order_id)
+        if order_id in unpaid:
+            logging.info(f"Order {order_id} marked as PAID")
+    for order_id, _ in expired:
+        forget_order(order_id)
+        if order_id in unpaid:
+            logging.info(f"Order {order_id} expired.")
+
+async def payment_poller():
+    logging.info("Started payment poller")
+    while True:
+        if pending_orders:
+            try:
+                await check_pending_payments()
+            except Exception as e:
+                logging.warning(f"Payment poll failed: {e}")
+        await asyncio.sleep(POLL_INTERVAL)
 
 # ---------- Routes ----------
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    # For demo, auto-login user 1
-    user_id = 1
-    username = "demo_user"
-    # Ensure user exists
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?, ?)", (user_id, username))
-        conn.commit()
-    ml_items = get_item_prices("MLBB")
-    ff_items = get_item_prices("FF")
-    return templates.TemplateResponse("mlbb.html", {"request": request, "ml_items": ml_items, "ff_items": ff_items, "reseller": is_reseller(user_id)})
+    # For demo, auto-login user 1 (created by init_db)
+    user_id = DEMO_USER_ID
+    items = get_all_item_prices()
+    return templates.TemplateResponse("mlbb.html", {"request": request, "ml_items": items["MLBB"], "ff_items": items["FF"], "reseller": await is_reseller(user_id)})
 
 @app.post("/buy", response_class=HTMLResponse)
 async def buy(request: Request,
@@ -197,41 +336,75 @@ async def buy(request: Request,
               item_id: str = Form(...),
               server_id: str = Form(...),
               zone_id: str = Form(...)):
-    user_id = 1  # demo user
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("SELECT normal_price FROM item_prices WHERE item_id=? AND game=?", (item_id, game))
-        row = c.fetchone()
-        if not row:
-            return HTMLResponse("Item not found", status_code=400)
-        amount = float(row[0])
+    user_id = DEMO_USER_ID
+    price = get_item_prices(game).get(item_id)
+    if not price:
+        return HTMLResponse("Item not found", status_code=400)
+    amount = float(price["normal"])
     order_id = generate_short_transaction_id()
-    qr_b64, md5 = generate_qr_code(amount)
+    qr_b64, md5 = await asyncio.get_running_loop().run_in_executor(QR_POOL, generate_qr_code, amount)
     if not qr_b64:
         return HTMLResponse("Failed to generate QR", status_code=500)
     created_at = now_iso()
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO orders (order_id, user_id, game, item_id, amount, server_id, zone_id, md5, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (order_id, user_id, game, item_id, amount, server_id, zone_id, md5, "UNPAID", created_at))
-        conn.commit()
+    async with pool.connection() as conn:
+        await conn.execute(SQL_INSERT_ORDER, (order_id, user_id, game, item_id, amount, server_id, zone_id, md5, "UNPAID", created_at))
     users_in_payment[user_id] = order_id
-    # start background checker
-    asyncio.create_task(check_payment_background(order_id, md5, user_id))
+    # hand the order to the background poller
+    pending_orders[order_id] = (md5, user_id, datetime.now().timestamp())
     return templates.TemplateResponse("deposit.html", {"request": request, "qr": qr_b64, "order_id": order_id, "amount": amount})
 
 @app.get("/order_status/{order_id}")
 async def order_status(order_id: str):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("SELECT status, payment_response, paid_at FROM orders WHERE order_id=?", (order_id,))
-        r = c.fetchone()
+    async with pool.connection() as conn:
+        c = await conn.execute(SQL_ORDER_STATUS, (order_id,))
+        r = await c.fetchone()
     if not r:
         return JSONResponse({"error": "not found"}, status_code=404)
     return {"status": r[0], "payment_response": r[1], "paid_at": r[2]}
 
+@app.post("/payment_webhook/{md5}")
+async def payment_webhook(md5: str, request: Request):
+    if not WEBHOOK_SECRET:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    body = await request.body()
+    # The signature covers "<timestamp>.<md5>.<body>" so it cannot be replayed
+    # later or reused against another order
+    timestamp = request.headers.get("X-Timestamp", "")
+    # Unix seconds only; the length bound keeps int() inside float range
+    if not (timestamp.isascii() and timestamp.isdigit() and len(timestamp) <= 12):
+        return JSONResponse({"error": "invalid timestamp"}, status_code=401)
+    if abs(datetime.now().timestamp() - int(timestamp)) > WEBHOOK_TOLERANCE:
+        return JSONResponse({"error": "stale request"}, status_code=401)
+    message = f"{timestamp}.{md5}.".encode() + body
+    expected = hmac.new(WEBHOOK_SECRET.encode(), message, hashlib.sha256).hexdigest()
+    # Headers are latin-1 decoded; compare bytes so non-ASCII input fails cleanly
+    if not hmac.compare_digest(expected.encode(), request.headers.get("X-Signature", "").encode("latin-1")):
+        return JSONResponse({"error": "invalid signature"}, status_code=401)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or data.get("status") != "PAID" or data.get("md5", md5) != md5:
+        return JSONResponse({"error": "invalid payload"}, status_code=400)
+    paid_at = now_iso()
+    async with pool.connection() as conn:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            c = await conn.execute(SQL_FIND_SETTLEABLE_BY_MD5, (md5,))
+            row = await c.fetchone()
+            if row:
+                await conn.execute(SQL_MARK_PAID, ("PAID", paid_at, row[0]))
+                await conn.execute(SQL_INSERT_EVENT, (row[0], paid_at, json.dumps(data, separators=(",", ":"))))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    if not row:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    forget_order(row[0])
+    logging.info(f"Order {row[0]} marked as PAID via webhook")
+    return {"status": "PAID", "order_id": row[0]}
+
 # ---------- Start ----------
 init_db()
 
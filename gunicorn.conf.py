@@ -0,0 +1,8 @@
+import os
+
+# Production server: gunicorn -c gunicorn.conf.py app:app
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn_worker.UvicornWorker"
+# Import app.py (and run init_db) once in the master before forking workers
+preload_app = True